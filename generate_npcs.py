@@ -1,12 +1,21 @@
+import functools
+import json
 import os
 import re
-import json
 import sqlite3
-from typing import Dict, Any, Tuple, List, Optional
+import sys
+import unicodedata
+from types import MappingProxyType
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, Any, Tuple, List, Mapping, Optional
 import xml.etree.ElementTree as ET
 
-from tibiawikisql.models.npc import Npc
-from tibiawikisql.models.item import Item
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib parser is just slower
+    orjson = None
 
 # === CONFIG ===
 
@@ -14,12 +23,16 @@ DB_PATH = "tibiawiki.db"
 
 OUTPUT_ROOT = "output"
 
+# Threads used to write the generated files
+WRITE_WORKERS = min(16, (os.cpu_count() or 1) * 4)
+
 # Optional outfit mapping file (NPC name -> outfit dict)
 OUTFITS_JSON = "outfits.json"
 OUTFITS_XML = "outfits.xml"
 
 # Default outfit if none is found for an NPC in outfits.json
-DEFAULT_OUTFIT_MALE = {
+# (read-only, shared by every NPC that falls back to it)
+DEFAULT_OUTFIT_MALE = MappingProxyType({
     "type": 130,  # mage male
     "head": 19,
     "body": 86,
@@ -27,10 +40,10 @@ DEFAULT_OUTFIT_MALE = {
     "feet": 95,
     "addons": 0,
     "sex": "male",
-}
+})
 
 # Rough female variant for fallback when no explicit outfit is known
-DEFAULT_OUTFIT_FEMALE = {
+DEFAULT_OUTFIT_FEMALE = MappingProxyType({
     "type": 138,  # mage female
     "head": 19,
     "body": 86,
@@ -38,25 +51,64 @@ DEFAULT_OUTFIT_FEMALE = {
     "feet": 95,
     "addons": 0,
     "sex": "female",
-}
+})
+
+
+# Characters that are not allowed in a slug
+_SLUG_RE = re.compile(r"[^a-z0-9_]+")
+
+# city_slug -> (npc_dir, scripts_dir, shops_dir) for folders already created
+_CITY_DIR_CACHE: Dict[str, Tuple[Path, Path, Path]] = {}
+
+# Basic NPCSystem script; "{NPC}" is replaced with the NPC name
+_LUA_TEMPLATE = """local keywordHandler = KeywordHandler:new()
+local npcHandler = NpcHandler:new(keywordHandler)
+NpcSystem.parseParameters(npcHandler)
+
+function onCreatureAppear(cid) npcHandler:onCreatureAppear(cid) end
+function onCreatureDisappear(cid) npcHandler:onCreatureDisappear(cid) end
+function onCreatureSay(cid, type, msg) npcHandler:onCreatureSay(cid, type, msg) end
+function onThink() npcHandler:onThink() end
+
+local function creatureSayCallback(cid, type, msg)
+    if not npcHandler:isFocused(cid) then
+        return false
+    end
+    -- Add custom conversation logic for {NPC} here if you want.
+    return true
+end
+
+npcHandler:setCallback(CALLBACK_MESSAGE_DEFAULT, creatureSayCallback)
+npcHandler:addModule(FocusModule:new())
+"""
 
 
 # === HELPERS ===
 
 
+def _slugify(text: str) -> str:
+    """
+    Lowercase, turn spaces into underscores and drop anything outside [a-z0-9_].
+    Accented letters are folded to their ASCII base letter first.
+    """
+    text = text.strip().lower().replace(" ", "_")
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii")
+    return _SLUG_RE.sub("", text)
+
+
 def slugify_name(name: str) -> str:
     """
     Convert an NPC name to a safe file-base:
     'Simon The Beggar' -> 'simon_the_beggar'
     """
-    name = name.strip().lower()
-    name = name.replace(" ", "_")
-    name = re.sub(r"[^a-z0-9_]+", "", name)
+    name = _slugify(name)
     if not name:
         name = "npc"
     return name
 
 
+@functools.lru_cache(maxsize=None)
 def slugify_city(city: str) -> str:
     """
     Convert a city name to a safe folder name.
@@ -64,9 +116,7 @@ def slugify_city(city: str) -> str:
     """
     if not city:
         return "unknown"
-    city = city.strip().lower()
-    city = city.replace(" ", "_")
-    city = re.sub(r"[^a-z0-9_]+", "", city)
+    city = _slugify(city)
     if not city:
         city = "unknown"
     return city
@@ -89,10 +139,11 @@ def load_outfits(path: str) -> Dict[str, Dict[str, Any]]:
     Load outfits.json if it exists; otherwise return empty mapping.
     Keys are NPC names as they appear in TibiaWiki (e.g. 'Xodet').
     """
-    if not os.path.exists(path):
+    json_path = Path(path)
+    if not json_path.is_file():
         return {}
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
+    raw = json_path.read_bytes()
+    data = orjson.loads(raw) if orjson is not None else json.loads(raw)
     # normalize keys to lowercase for case-insensitive lookup
     return {k.lower(): v for k, v in data.items()}
 
@@ -106,12 +157,14 @@ def load_outfits_xml(path: str) -> Dict[Tuple[str, str], int]:
     if not os.path.exists(path):
         return mapping
 
-    tree = ET.parse(path)
-    root = tree.getroot()
-    for outfit in root.findall("outfit"):
-        name = outfit.attrib.get("name")
-        looktype = outfit.attrib.get("looktype")
-        sex_type = outfit.attrib.get("type")
+    # Stream the file and drop each element once read instead of keeping the whole tree
+    for _, outfit in ET.iterparse(path, events=("end",)):
+        if outfit.tag != "outfit":
+            continue
+        name = outfit.get("name")
+        looktype = outfit.get("looktype")
+        sex_type = outfit.get("type")
+        outfit.clear()
         if not name or looktype is None or sex_type is None:
             continue
         sex = "female" if sex_type == "0" else "male"
@@ -133,10 +186,10 @@ def normalize_gender(gender: Optional[str]) -> Optional[str]:
     return None
 
 
-def default_outfit_for_gender(gender: Optional[str]) -> Dict[str, Any]:
+def default_outfit_for_gender(gender: Optional[str]) -> Mapping[str, Any]:
     if gender == "female":
-        return DEFAULT_OUTFIT_FEMALE.copy()
-    return DEFAULT_OUTFIT_MALE.copy()
+        return DEFAULT_OUTFIT_FEMALE
+    return DEFAULT_OUTFIT_MALE
 
 
 def get_outfit_for_npc(
@@ -144,38 +197,37 @@ def get_outfit_for_npc(
     npc_gender: Optional[str],
     outfits: Dict[str, Dict[str, Any]],
     xml_lookup: Dict[Tuple[str, str], int],
-) -> Dict[str, Any]:
+) -> Mapping[str, Any]:
     """
     Return outfit dict for the NPC:
     - if present in outfits.json (case-insensitive), use that
     - otherwise use a gender-aware default
     After merging, try to map to outfits.xml by outfit_name/sex to obtain the
     correct looktype for the current server outfits configuration.
+    NPCs without a mapping share the read-only default outfit.
     """
     gender = normalize_gender(npc_gender)
-    key = npc_name.lower()
     base = default_outfit_for_gender(gender)
 
-    if key not in outfits:
-        base["sex"] = base.get("sex") or gender or "unknown"
+    outfit = outfits.get(npc_name.lower())
+    if outfit is None:
         return base
 
-    outfit = outfits[key]
-    result = base.copy()
-    result.update(outfit)
+    result = {**base, **outfit}
     # Ensure sex is set and prefer the NPC gender when available
-    result["sex"] = normalize_gender(result.get("sex")) or gender or base.get("sex") or "unknown"
+    result["sex"] = normalize_gender(result.get("sex")) or gender or base["sex"]
 
     # Map to server looktype via outfits.xml if possible
     outfit_name = result.get("outfit_name")
     sex_key = result["sex"]
     looktype = None
     if outfit_name:
-        looktype = xml_lookup.get((outfit_name.lower(), sex_key))
+        outfit_name = outfit_name.lower()
+        looktype = xml_lookup.get((outfit_name, sex_key))
         if looktype is None:
             # Fallback: try the opposite sex if not found under requested one
-            looktype = xml_lookup.get((outfit_name.lower(), "male")) or xml_lookup.get(
-                (outfit_name.lower(), "female")
+            looktype = xml_lookup.get((outfit_name, "male")) or xml_lookup.get(
+                (outfit_name, "female")
             )
 
     if looktype is not None:
@@ -194,85 +246,82 @@ def build_shop_value(entries: List[Tuple[str, int, int]]) -> str:
     if not entries:
         return ""
 
-    lines = []
-    for name, client_id, price in entries:
-        # Do minimal XML escaping in the item name
-        escaped_name = xml_escape_attr(name)
-        lines.append(f"\t\t\t{escaped_name},{client_id},{price};")
-
-    return "\n" + "\n".join(lines)
+    # Do minimal XML escaping in the item name
+    return "\n" + "\n".join(
+        [f"\t\t\t{xml_escape_attr(name)},{client_id},{price};" for name, client_id, price in entries]
+    )
 
 
-def ensure_city_dirs(city_slug: str) -> Tuple[str, str, str]:
+def ensure_city_dirs(city_slug: str) -> Tuple[Path, Path, Path]:
     """
     Make sure the folders for a given city exist and return:
     (npc_dir, scripts_dir, shops_dir)
+    Folders are only created the first time a city is seen.
     """
-    npc_dir = os.path.join(OUTPUT_ROOT, city_slug)
-    scripts_dir = os.path.join(npc_dir, "scripts")
-    shops_dir = os.path.join(npc_dir, "shops")
+    cached = _CITY_DIR_CACHE.get(city_slug)
+    if cached is not None:
+        return cached
+
+    npc_dir = Path(OUTPUT_ROOT) / city_slug
+    scripts_dir = npc_dir / "scripts"
+    shops_dir = npc_dir / "shops"
 
-    os.makedirs(npc_dir, exist_ok=True)
-    os.makedirs(scripts_dir, exist_ok=True)
-    os.makedirs(shops_dir, exist_ok=True)
+    # Creating the subfolders also creates npc_dir
+    scripts_dir.mkdir(parents=True, exist_ok=True)
+    shops_dir.mkdir(parents=True, exist_ok=True)
 
-    return npc_dir, scripts_dir, shops_dir
+    _CITY_DIR_CACHE[city_slug] = (npc_dir, scripts_dir, shops_dir)
+    return _CITY_DIR_CACHE[city_slug]
 
 
 def create_npc_xml(
-    npc: Npc, npc_dir: str, file_base: str, outfit: Dict[str, Any], has_shop: bool
+    npc: sqlite3.Row, npc_dir: Path, file_base: str, outfit: Mapping[str, Any], has_shop: bool
 ) -> None:
     """
     Create the NPC .xml file in the city's folder.
     """
-    npc_name = npc.name or npc.title
-    npc_xml_path = os.path.join(npc_dir, f"{file_base}.xml")
+    npc_name = npc["name"] or npc["title"]
+    npc_xml_path = npc_dir / f"{file_base}.xml"
 
     # Coordinates may be None for some NPCs
-    home_x = npc.x if npc.x is not None else 0
-    home_y = npc.y if npc.y is not None else 0
-    home_z = npc.z if npc.z is not None else 7
+    home_x = npc["x"] if npc["x"] is not None else 0
+    home_y = npc["y"] if npc["y"] is not None else 0
+    home_z = npc["z"] if npc["z"] is not None else 7
 
     # Script and shop file names (relative to the city's NPC XML location)
     script_file = f"scripts/{file_base}.lua"
     shop_file = f"shops/{file_base}.shop"
 
-    lines = []
-    lines.append('<?xml version="1.0" encoding="UTF-8"?>')
-    lines.append(
+    shop_block = (
+        "\t<parameters>\n"
+        '\t\t<parameter key="module_shop" value="1" />\n'
+        f'\t\t<parameter key="shop_file" value="{xml_escape_attr(shop_file)}" />\n'
+        "\t</parameters>\n"
+        if has_shop
+        else ""
+    )
+    contents = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
         f'<npc name="{xml_escape_attr(npc_name)}" '
         f'script="{xml_escape_attr(script_file)}" '
-        f'walkinterval="2000" floorchange="0">'
-    )
-    lines.append('\t<health now="100" max="100" />')
-    lines.append(
+        f'walkinterval="2000" floorchange="0">\n'
+        '\t<health now="100" max="100" />\n'
         f'\t<look type="{outfit["type"]}" '
         f'head="{outfit["head"]}" '
         f'body="{outfit["body"]}" '
         f'legs="{outfit["legs"]}" '
         f'feet="{outfit["feet"]}" '
-        f'addons="{outfit.get("addons", 0)}" />'
+        f'addons="{outfit.get("addons", 0)}" />\n'
+        f'\t<home x="{home_x}" y="{home_y}" z="{home_z}"/>\n'
+        f"{shop_block}"
+        "</npc>"
     )
-    lines.append(f'\t<home x="{home_x}" y="{home_y}" z="{home_z}"/>')
-
-    if has_shop:
-        lines.append("\t<parameters>")
-        lines.append('\t\t<parameter key="module_shop" value="1" />')
-        lines.append(
-            f'\t\t<parameter key="shop_file" '
-            f'value="{xml_escape_attr(shop_file)}" />'
-        )
-        lines.append("\t</parameters>")
-
-    lines.append("</npc>")
-    contents = "\n".join(lines)
 
-    with open(npc_xml_path, "w", encoding="utf-8") as f:
-        f.write(contents)
+    npc_xml_path.write_text(contents, encoding="utf-8")
 
 
 def create_shop_xml(
-    shops_dir: str,
+    shops_dir: Path,
     file_base: str,
     buyable_entries: List[Tuple[str, int, int]],
     sellable_entries: List[Tuple[str, int, int]],
@@ -280,72 +329,64 @@ def create_shop_xml(
     """
     Create the shop .shop XML file for one NPC in the city's shops folder.
     """
-    shop_path = os.path.join(shops_dir, f"{file_base}.shop")
+    shop_path = shops_dir / f"{file_base}.shop"
 
     buyable_str = build_shop_value(buyable_entries)
     sellable_str = build_shop_value(sellable_entries)
 
-    lines = []
-    lines.append('<?xml version="1.0" encoding="UTF-8"?>')
-    lines.append("<shop>")
-    lines.append("\t<parameters>")
-
-    if buyable_entries:
-        lines.append(
-            '\t\t<parameter key="shop_buyable" value="'
-            + buyable_str.replace('"', "&quot;")
-            + '" />'
-        )
-
-    if sellable_entries:
-        lines.append(
-            '\t\t<parameter key="shop_sellable" value="'
-            + sellable_str.replace('"', "&quot;")
-            + '" />'
-        )
-
-    lines.append("\t</parameters>")
-    lines.append("</shop>")
-
-    contents = "\n".join(lines)
+    buyable_line = (
+        f'\t\t<parameter key="shop_buyable" value="{buyable_str}" />\n' if buyable_entries else ""
+    )
+    sellable_line = (
+        f'\t\t<parameter key="shop_sellable" value="{sellable_str}" />\n' if sellable_entries else ""
+    )
+    contents = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        "<shop>\n"
+        "\t<parameters>\n"
+        f"{buyable_line}"
+        f"{sellable_line}"
+        "\t</parameters>\n"
+        "</shop>"
+    )
 
-    with open(shop_path, "w", encoding="utf-8") as f:
-        f.write(contents)
+    shop_path.write_text(contents, encoding="utf-8")
 
 
-def create_lua_script(scripts_dir: str, file_base: str, npc_name: str) -> None:
+def create_lua_script(scripts_dir: Path, file_base: str, npc_name: str) -> None:
     """
     Create a simple Lua script for the NPC (no 'first rod' logic, just basic NPCSystem),
     in the city's scripts folder.
     """
-    lua_path = os.path.join(scripts_dir, f"{file_base}.lua")
+    lua_path = scripts_dir / f"{file_base}.lua"
 
-    lua_code = f"""local keywordHandler = KeywordHandler:new()
-local npcHandler = NpcHandler:new(keywordHandler)
-NpcSystem.parseParameters(npcHandler)
+    lua_path.write_text(_LUA_TEMPLATE.replace("{NPC}", npc_name), encoding="utf-8")
 
-function onCreatureAppear(cid) npcHandler:onCreatureAppear(cid) end
-function onCreatureDisappear(cid) npcHandler:onCreatureDisappear(cid) end
-function onCreatureSay(cid, type, msg) npcHandler:onCreatureSay(cid, type, msg) end
-function onThink() npcHandler:onThink() end
 
-local function creatureSayCallback(cid, type, msg)
-    if not npcHandler:isFocused(cid) then
-        return false
-    end
-    -- Add custom conversation logic for {npc_name} here if you want.
-    return true
-end
+def write_npc_files(
+    npc: sqlite3.Row,
+    npc_dir: Path,
+    scripts_dir: Path,
+    shops_dir: Path,
+    file_base: str,
+    outfit: Mapping[str, Any],
+    buyable_entries: List[Tuple[str, int, int]],
+    sellable_entries: List[Tuple[str, int, int]],
+) -> None:
+    """
+    Write the .xml, .lua and (if the NPC trades) .shop files for one NPC.
+    """
+    has_shop = bool(buyable_entries or sellable_entries)
 
-npcHandler:setCallback(CALLBACK_MESSAGE_DEFAULT, creatureSayCallback)
-npcHandler:addModule(FocusModule:new())
-"""
+    create_npc_xml(npc, npc_dir, file_base, outfit, has_shop=has_shop)
+
+    if has_shop:
+        create_shop_xml(shops_dir, file_base, buyable_entries, sellable_entries)
 
-    with open(lua_path, "w", encoding="utf-8") as f:
-        f.write(lua_code)
+    create_lua_script(scripts_dir, file_base, npc["name"] or npc["title"])
 
 
-def main():
+def main(verbose: bool = False):
     # Root output folder
     os.makedirs(OUTPUT_ROOT, exist_ok=True)
 
@@ -355,66 +396,84 @@ def main():
 
     # Connect to tibiawiki.db
     conn = sqlite3.connect(DB_PATH)
+    conn.row_factory = sqlite3.Row
+    cur = conn.cursor()
+
+    # Load every NPC and every offer up front (one scan per table) instead of
+    # querying the database once per NPC and once per offer. Item names are
+    # picked and lowercased by SQLite (actual_name, then name, then title).
+    cur.execute("SELECT article_id, title, name, gender, city, x, y, z FROM npc")
+    npcs = {row["article_id"]: row for row in cur}
+    print(f"Found {len(npcs)} NPCs in the database.")
+
+    # NPC SELL offers = items player can BUY from NPC
+    sell_by_npc: Dict[int, List[Tuple[str, int, int]]] = defaultdict(list)
+    cur.execute(
+        "SELECT o.npc_id, o.value, i.client_id, "
+        "LOWER(COALESCE(NULLIF(i.actual_name, ''), NULLIF(i.name, ''), i.title)) AS iname "
+        "FROM npc_offer_sell o JOIN item i ON i.article_id = o.item_id "
+        "WHERE i.client_id IS NOT NULL"
+    )
+    for row in cur:
+        sell_by_npc[row["npc_id"]].append((row["iname"], row["client_id"], row["value"]))
+
+    # NPC BUY offers = items player can SELL to NPC
+    buy_by_npc: Dict[int, List[Tuple[str, int, int]]] = defaultdict(list)
+    cur.execute(
+        "SELECT o.npc_id, o.value, i.client_id, "
+        "LOWER(COALESCE(NULLIF(i.actual_name, ''), NULLIF(i.name, ''), i.title)) AS iname "
+        "FROM npc_offer_buy o JOIN item i ON i.article_id = o.item_id "
+        "WHERE i.client_id IS NOT NULL"
+    )
+    for row in cur:
+        buy_by_npc[row["npc_id"]].append((row["iname"], row["client_id"], row["value"]))
 
-    # Get all NPC article_ids from the npc table
-    cur = conn.cursor()
-    cur.execute("SELECT article_id FROM npc")
-    npc_ids = [row[0] for row in cur.fetchall()]
-    print(f"Found {len(npc_ids)} NPCs in the database.")
-
-    for article_id in npc_ids:
-        npc = Npc.get_one_by_field(conn, "article_id", article_id)
-        if npc is None:
-            continue
-
-        npc_name = npc.name or npc.title
-        file_base = slugify_name(npc_name)
+    conn.close()
 
-        # City folder
-        city_name = npc.city or ""
-        city_slug = slugify_city(city_name)
+    # Group NPCs by city so each city's folders are prepared only once
+    npcs_by_city: Dict[str, List[sqlite3.Row]] = defaultdict(list)
+    for npc in npcs.values():
+        npcs_by_city[slugify_city(npc["city"] or "")].append(npc)
+
+    # Work out everything for each NPC here, then hand the file writing to a
+    # thread pool: the writes are independent and I/O-bound. Jobs are keyed by
+    # output file so NPCs sharing a file name still resolve to the last one.
+    jobs: Dict[Tuple[Path, str], tuple] = {}
+    report: List[str] = []
+    for city_slug, city_npcs in npcs_by_city.items():
         npc_dir, scripts_dir, shops_dir = ensure_city_dirs(city_slug)
 
-        # Outfit
-        outfit = get_outfit_for_npc(npc_name, npc.gender, outfits_map, outfits_xml_map)
-
-        # Build shop entries using NPC offers and Item.client_id
-        buyable_entries: List[Tuple[str, int, int]] = []  # Player sells to NPC (NPC buys)
-        sellable_entries: List[Tuple[str, int, int]] = []  # Player buys from NPC (NPC sells)
-
-        # NPC SELL offers = items player can BUY from NPC
-        for offer in npc.sell_offers or []:
-            item = Item.get_one_by_field(conn, "article_id", offer.item_id)
-            if not item or item.client_id is None:
-                continue
-            item_name = (item.actual_name or item.name or offer.item_title).lower()
-            sellable_entries.append((item_name, item.client_id, offer.value))
-
-        # NPC BUY offers = items player can SELL to NPC
-        for offer in npc.buy_offers or []:
-            item = Item.get_one_by_field(conn, "article_id", offer.item_id)
-            if not item or item.client_id is None:
-                continue
-            item_name = (item.actual_name or item.name or offer.item_title).lower()
-            buyable_entries.append((item_name, item.client_id, offer.value))
-
-        has_shop = bool(buyable_entries or sellable_entries)
-
-        # Generate files under that city's folder
-        create_npc_xml(npc, npc_dir, file_base, outfit, has_shop=has_shop)
-
-        if has_shop:
-            create_shop_xml(shops_dir, file_base, buyable_entries, sellable_entries)
-
-        create_lua_script(scripts_dir, file_base, npc_name)
-
-        print(
-            f"[{city_slug}] Generated NPC: {npc_name} -> {file_base}.xml / .lua / .shop"
-        )
-
-    conn.close()
+        for npc in city_npcs:
+            article_id = npc["article_id"]
+            npc_name = npc["name"] or npc["title"]
+            file_base = slugify_name(npc_name)
+
+            # Outfit
+            outfit = get_outfit_for_npc(npc_name, npc["gender"], outfits_map, outfits_xml_map)
+
+            # Shop entries as (name, client_id, price)
+            buyable_entries = buy_by_npc.get(article_id, [])  # Player sells to NPC (NPC buys)
+            sellable_entries = sell_by_npc.get(article_id, [])  # Player buys from NPC (NPC sells)
+
+            jobs[(npc_dir, file_base)] = (
+                npc, npc_dir, scripts_dir, shops_dir, file_base, outfit, buyable_entries, sellable_entries
+            )
+            if verbose:
+                report.append(
+                    f"[{city_slug}] Generated NPC: {npc_name} -> {file_base}.xml / .lua / .shop\n"
+                )
+
+    with ThreadPoolExecutor(max_workers=WRITE_WORKERS) as executor:
+        futures = [executor.submit(write_npc_files, *job) for job in jobs.values()]
+        for future in futures:
+            future.result()
+
+    # Per-NPC lines only with --verbose, written in one go instead of a print each
+    if report:
+        sys.stdout.write("".join(report))
+    print(f"Generated {len(jobs)} NPCs across {len(npcs_by_city)} cities.")
     print("Done. Files written under:", OUTPUT_ROOT)
 
 
 if __name__ == "__main__":
-    main()
+    main(verbose="--verbose" in sys.argv[1:])
@@ -1,30 +1,65 @@
 import contextlib
+import functools
 import json
 import os
 import re
 import sqlite3
 import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional
-from urllib.parse import urlparse, parse_qs
+from urllib.parse import unquote_plus, urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson
+except ImportError:  # orjson is optional, the stdlib encoder is just slower
+    orjson = None
 
 NPC_OUTFITTER_PAGE = "NPC Outfitter Codes"
 MW_API_URL = "https://tibia.fandom.com/api.php"
 OUTPUT_JSON = "outfits.json"
 DB_PATH = "tibiawiki.db"
 OUTFITS_XML = "outfits.xml"
+FETCH_WORKERS = 4
+
+# Shared session so every API call reuses the same pooled keep-alive connection
+_SESSION = requests.Session()
+_SESSION.headers.update(
+    {"User-Agent": "Mozilla/5.0 (NPC outfit scraper)", "Accept-Encoding": "gzip"}
+)
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=Retry(total=3, backoff_factor=0.3)),
+)
+
+_NPC_SUFFIX_RE = re.compile(r"\s*\(NPC\)\s*$")
+# The lookbehind keeps "male_id" from matching inside "female_id"
+_MALE_ID_RE = re.compile(r"(?<![a-z])male_id\s*=\s*([0-9]+)")
+_FEMALE_ID_RE = re.compile(r"female_id\s*=\s*([0-9]+)")
+
+
+def dump_json(obj: Any) -> bytes:
+    """
+    Serialize obj as indented UTF-8 JSON, using orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+    return json.dumps(obj, indent=2, ensure_ascii=False).encode("utf-8")
 
 
 def normalize_name(name: str) -> str:
     return name.strip()
 
 
+@functools.lru_cache(maxsize=4096)
 def alt_name_without_npc_suffix(name: str) -> str:
     """
     'Akananto (NPC)' -> 'Akananto'
     """
-    return re.sub(r"\s*\(NPC\)\s*$", "", name).strip()
+    return _NPC_SUFFIX_RE.sub("", name).strip()
 
 
 def normalize_gender(flag: Optional[str]) -> Optional[str]:
@@ -49,13 +84,22 @@ def parse_outfiter_url(url: str) -> Dict[str, Any]:
     Parse an Outfiter URL and return a dict with outfit info:
     {type, head, body, legs, feet, addons, sex}
     """
-    parsed = urlparse(url)
-    qs = parse_qs(parsed.query)
+    # The keys are a small fixed set of plain ints/flags, so a single split
+    # is enough; like parse_qs, blank values are dropped, the first value wins
+    # and percent/plus-encoded parts are decoded (only when they need it).
+    qs: Dict[str, str] = {}
+    for pair in urlparse(url).query.split("&"):
+        key, _, val = pair.partition("=")
+        if not val:
+            continue
+        if "%" in key or "+" in key:
+            key = unquote_plus(key)
+        if "%" in val or "+" in val:
+            val = unquote_plus(val)
+        qs.setdefault(key, val)
 
     def get_int(key: str) -> Optional[int]:
-        if key not in qs:
-            return None
-        val = qs[key][0]
+        val = qs.get(key)
         if not val:
             return None
         try:
@@ -81,7 +125,7 @@ def parse_outfiter_url(url: str) -> Dict[str, Any]:
     if "fm" in qs:
         sex = "female"
     elif "f" in qs:
-        sex = normalize_gender(qs["f"][0])
+        sex = normalize_gender(qs["f"])
 
     result: Dict[str, Any] = {}
     if outfit_type is not None:
@@ -102,7 +146,7 @@ def parse_outfiter_url(url: str) -> Dict[str, Any]:
 
 
 def fetch_page_wikitext(title: str) -> str:
-    resp = requests.get(
+    resp = _SESSION.get(
         MW_API_URL,
         params={
             "action": "query",
@@ -112,7 +156,7 @@ def fetch_page_wikitext(title: str) -> str:
             "rvprop": "content",
             "titles": title,
         },
-        headers={"User-Agent": "Mozilla/5.0 (NPC outfit scraper)"},
+        timeout=30,
     )
     resp.raise_for_status()
     data = resp.json()
@@ -133,11 +177,7 @@ def parse_outfitter_template(template: str) -> Dict[str, str]:
     """
     Parse a simple {{Outfitter|...}} template string into a dict.
     """
-    template = template.strip()
-    if template.startswith("{{"):
-        template = template[2:]
-    if template.endswith("}}"):
-        template = template[:-2]
+    template = template.strip().removeprefix("{{").removesuffix("}}")
     parts = template.split("|")
     params: Dict[str, str] = {}
     for part in parts[1:]:
@@ -155,18 +195,24 @@ def parse_wikitext_rows(wikitext: str):
     The export keeps each row on a single line after a "|-" separator, so we
     parse line-by-line to avoid capturing separators as part of the name.
     """
+    # Locate the first three "||" cells with find() instead of splitting every
+    # row into a list of all its cells.
     for line in wikitext.splitlines():
         line = line.strip()
         if not line.startswith("| "):
             continue
-        # drop leading "| "
-        row = line[2:]
-        parts = [p.strip() for p in row.split("||")]
-        if len(parts) < 3:
+        first = line.find("||", 2)
+        if first < 0:
+            continue
+        second = line.find("||", first + 2)
+        if second < 0:
             continue
-        name, link, template_str = parts[:3]
+        third = line.find("||", second + 2)
+        template_str = (line[second + 2 : third] if third >= 0 else line[second + 2 :]).strip()
         if not template_str.startswith("{{"):
             continue
+        name = line[2:first].strip()
+        link = line[first + 2 : second].strip()
         yield normalize_name(name), link, template_str
 
 
@@ -185,12 +231,13 @@ def build_looktype_map() -> Dict[int, Dict[str, Any]]:
     outfits = cur.fetchall()
     conn.close()
 
-    # Request in batches to reduce round-trips
-    batch_size = 20
-    for i in range(0, len(outfits), batch_size):
-        batch = outfits[i : i + batch_size]
+    # Request in batches to reduce round-trips (50 titles is the API limit)
+    batch_size = 50
+    batches = [outfits[i : i + batch_size] for i in range(0, len(outfits), batch_size)]
+
+    def fetch_batch(batch) -> Dict[str, str]:
         titles = "|".join(title for _, title, _ in batch)
-        resp = requests.get(
+        resp = _SESSION.get(
             MW_API_URL,
             params={
                 "action": "query",
@@ -200,11 +247,11 @@ def build_looktype_map() -> Dict[int, Dict[str, Any]]:
                 "rvprop": "content",
                 "titles": titles,
             },
-            headers={"User-Agent": "Mozilla/5.0 (NPC outfit scraper)"},
+            timeout=30,
         )
         resp.raise_for_status()
         pages = resp.json().get("query", {}).get("pages", {}) or {}
-        title_to_content = {
+        return {
             page.get("title"): (
                 page.get("revisions", [{}])[0]
                 .get("slots", {})
@@ -215,10 +262,16 @@ def build_looktype_map() -> Dict[int, Dict[str, Any]]:
             for page in pages.values()
         }
 
+    # The requests are network-bound, so overlap them; keep concurrency low
+    # to stay polite with the Fandom API.
+    with ThreadPoolExecutor(max_workers=FETCH_WORKERS) as executor:
+        results = list(executor.map(fetch_batch, batches))
+
+    for batch, title_to_content in zip(batches, results):
         for article_id, title, name in batch:
             content = title_to_content.get(title) or ""
-            male_match = re.search(r"male_id\s*=\s*([0-9]+)", content)
-            female_match = re.search(r"female_id\s*=\s*([0-9]+)", content)
+            male_match = _MALE_ID_RE.search(content)
+            female_match = _FEMALE_ID_RE.search(content)
             if male_match:
                 looktype_map[int(male_match.group(1))] = {
                     "outfit_id": article_id,
@@ -246,12 +299,14 @@ def load_outfits_xml_lookup(path: str) -> tuple[Dict[int, Dict[str, Any]], Dict[
     if not os.path.exists(path):
         return mapping, ordered
 
-    tree = ET.parse(path)
-    root = tree.getroot()
-    for outfit in root.findall("outfit"):
-        looktype = outfit.attrib.get("looktype")
-        name = outfit.attrib.get("name")
-        sex_type = outfit.attrib.get("type")
+    # Stream the file and drop each element once read instead of keeping the whole tree
+    for _, outfit in ET.iterparse(path, events=("end",)):
+        if outfit.tag != "outfit":
+            continue
+        looktype = outfit.get("looktype")
+        name = outfit.get("name")
+        sex_type = outfit.get("type")
+        outfit.clear()
         if not name or looktype is None or sex_type is None:
             continue
         sex = "female" if sex_type == "0" else "male"
@@ -353,13 +408,14 @@ def main():
         if alt and alt != npc_name:
             outfits.setdefault(alt, outfit_info)
 
-    # Sort keys for nicer JSON
-    sorted_outfits = dict(sorted(outfits.items(), key=lambda kv: kv[0].lower()))
+    # Sort keys (case-insensitive) for nicer JSON; only the keys are sorted,
+    # then a single ordered dict is built from them
+    outfits = {key: outfits[key] for key in sorted(outfits, key=str.lower)}
 
-    with open(OUTPUT_JSON, "w", encoding="utf-8") as f:
-        json.dump(sorted_outfits, f, indent=2, ensure_ascii=False)
+    with open(OUTPUT_JSON, "wb") as f:
+        f.write(dump_json(outfits))
 
-    print(f"Wrote {len(sorted_outfits)} entries to {OUTPUT_JSON}")
+    print(f"Wrote {len(outfits)} entries to {OUTPUT_JSON}")
 
 
 if __name__ == "__main__":